@@ -17,6 +17,33 @@ class ExportEntriesActionEntryPoint(ActionEntryPoint):
         description='Maximum number of entries that can be exported in a single '
         'Export Entries action.',
     )
+    max_concurrent_searches: int = Field(
+        default=4,
+        gt=0,
+        description='Maximum number of search pages fetched concurrently in the '
+        'Export Entries action.',
+    )
+    search_cache_max_age: int = Field(
+        default=0,
+        ge=0,
+        description='Time (in seconds) for which the search pages of the Export '
+        'Entries action are cached, and reused by exports with the same user and '
+        'search settings. The exported metadata then reports the search times of '
+        'the cached pages. Set to 0 to disable the cache.',
+    )
+    search_cache_max_size: int = Field(
+        default=10 * 1024**3,  # 10 GiB
+        ge=0,
+        description='Maximum size (in bytes) of the cached search pages of the '
+        'Export Entries action. The least recently cached pages are evicted first.',
+    )
+    merge_batch_rows: int = Field(
+        default=64 * 1024,
+        gt=0,
+        description='Number of rows read and written at once when merging the '
+        'search pages of the Export Entries action into the exported file. Reduce it '
+        'to lower the memory usage when exporting entries with many quantities.',
+    )
 
     def load(self):
         from nomad.actions import Action
@@ -27,6 +54,7 @@ class ExportEntriesActionEntryPoint(ActionEntryPoint):
             export_dataset_to_upload,
             merge_output_files,
             search,
+            search_page_after_values,
         )
         from nomad_ml_workflows.actions.export_entries.workflows import (
             ExportEntriesWorkflow,
@@ -38,6 +66,7 @@ class ExportEntriesActionEntryPoint(ActionEntryPoint):
             activities=[
                 create_artifact_subdirectory,
                 search,
+                search_page_after_values,
                 merge_output_files,
                 export_dataset_to_upload,
                 cleanup_artifacts,
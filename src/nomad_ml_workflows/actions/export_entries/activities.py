@@ -1,10 +1,19 @@
-import json
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
 import os
+import pathlib
 import shutil
+import time
+import uuid
 import zipfile
+from collections.abc import Callable
 from datetime import datetime, timezone
 
+import orjson
 from nomad.actions.manager import action_artifacts_dir, get_upload_files
+from nomad.app.v1.models.models import MetadataPagination, MetadataRequired
 from nomad.files import StagingUploadFiles
 from nomad.search import search as nomad_search
 from temporalio import activity
@@ -19,10 +28,185 @@ from nomad_ml_workflows.actions.export_entries.models import (
 )
 from nomad_ml_workflows.actions.export_entries.utils import (
     merge_files,
+    open_sequential,
+    write_arrow_file,
     write_json_file,
     write_parquet_file,
 )
 
+# Result window of the Elasticsearch index. Only the leading search results before
+# it can be addressed by their offset, as `MetadataPagination` requires the offset
+# plus the page size to be smaller than the window.
+SEARCH_MAX_RESULT_WINDOW = 10000
+
+# Page size used to collect the `page_after_value` of the search pages. Only the
+# entry IDs are fetched, so the pages can be as large as Elasticsearch allows.
+PAGE_AFTER_VALUES_PAGE_SIZE = SEARCH_MAX_RESULT_WINDOW
+
+# Buffer size used to copy the dataset files into the zip file and to write the zip
+# file. `ZipFile.write` copies in chunks of 8 KiB, and the default buffer of the
+# written file has the same size, which costs one system call per chunk.
+ZIP_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Name of the directory in the action artifacts directory holding the cached search
+# pages
+SEARCH_CACHE_DIR_NAME = '_search_cache'
+
+# Writers of the batch files, by batch file type
+BATCH_FILE_WRITERS: dict[str, Callable[..., None]] = {
+    'parquet': write_parquet_file,
+    'arrow': write_arrow_file,
+    'json': write_json_file,
+}
+
+
+def _write_zip_file(zippath: str, source_paths: list[str], metadata_json: bytes):
+    """
+    Writes a zip file containing the source files and the metadata file.
+
+    Args:
+        zippath (str): Path of the zip file to be written.
+        source_paths (list[str]): List of paths to the source files of the dataset.
+        metadata_json (bytes): Serialized content of the metadata file.
+    """
+    with (
+        open(zippath, 'wb', buffering=ZIP_COPY_BUFFER_SIZE) as f,
+        zipfile.ZipFile(f, 'w', allowZip64=True) as zipf,
+    ):
+        for filepath in source_paths:
+            arcname = os.path.basename(filepath)
+            if filepath.endswith('.parquet'):
+                # Parquet files are already compressed, deflating them again costs
+                # CPU time without reducing the size. They are stored with a large
+                # copy buffer, as the copy is bound by memory bandwidth.
+                zinfo = zipfile.ZipInfo.from_file(filepath, arcname=arcname)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with (
+                    open_sequential(filepath, buffering=0) as src,
+                    zipf.open(zinfo, 'w') as dest,
+                ):
+                    shutil.copyfileobj(src, dest, ZIP_COPY_BUFFER_SIZE)
+            else:
+                zipf.write(
+                    filepath,
+                    arcname=arcname,
+                    compress_type=zipfile.ZIP_DEFLATED,
+                    compresslevel=1,
+                )
+        zipf.writestr(
+            'metadata.json',
+            metadata_json,
+            compress_type=zipfile.ZIP_DEFLATED,
+            compresslevel=1,
+        )
+
+
+def _link_or_copy(src: str, dst: str):
+    """
+    Hard-links the file `src` to `dst`, or copies it if linking is not possible, e.g.
+    because both paths are on different file systems.
+
+    Args:
+        src (str): Path of the source file.
+        dst (str): Path of the destination file.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _search_cache_key(data: SearchInput) -> str:
+    """
+    Computes the key of a cached search page from all the search inputs that
+    determine its content.
+
+    Args:
+        data (SearchInput): Input data for the search activity.
+
+    Returns:
+        str: Key of the cached search page.
+    """
+    inputs = data.model_dump(
+        mode='json', exclude={'output_file_path', 'cache_max_age', 'cache_max_size'}
+    )
+    return hashlib.blake2b(
+        orjson.dumps(inputs, option=orjson.OPT_SORT_KEYS), digest_size=20
+    ).hexdigest()
+
+
+def _read_search_cache(cache_path: str, data: SearchInput) -> SearchOutput | None:
+    """
+    Reads a cached search page. If it was cached within `data.cache_max_age`, its
+    batch file is copied to `data.output_file_path`. The batch files are copied from
+    and to the cache instead of linked, as the exported files are linked into the
+    upload, where they can be overwritten. The output keeps the start and end times
+    of the cached search, which are the times the exported entries were searched.
+
+    Args:
+        cache_path (str): Path of the cached search page, without extension.
+        data (SearchInput): Input data for the search activity.
+
+    Returns:
+        SearchOutput | None: Output of the cached search, or None if the search page
+            is not cached.
+    """
+    meta_path = cache_path + '.meta.json'
+    try:
+        if time.time() - os.stat(meta_path).st_mtime > data.cache_max_age:
+            return None
+        with open(meta_path, 'rb') as f:
+            output = SearchOutput.model_validate_json(f.read())
+        if output.num_entries_exported > 0:
+            shutil.copyfile(
+                f'{cache_path}.{data.batch_file_type}', data.output_file_path
+            )
+    except FileNotFoundError:
+        # not cached, or evicted in the meantime
+        return None
+    return output
+
+
+def _write_search_cache(cache_path: str, data: SearchInput, output: SearchOutput):
+    """
+    Caches a search page and evicts the cached search pages that are older than
+    `data.cache_max_age`, or the oldest ones beyond `data.cache_max_size`. The
+    batch file is cached before the output, so that only complete pages are read.
+    The partial files still being written by other searches are not evicted for the
+    size of the cache, only once they are older than `data.cache_max_age`.
+
+    Args:
+        cache_path (str): Path of the cached search page, without extension.
+        data (SearchInput): Input data for the search activity.
+        output (SearchOutput): Output of the search activity.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_path = f'{cache_path}.{uuid.uuid4().hex}.partial'
+    if output.num_entries_exported > 0:
+        shutil.copyfile(data.output_file_path, partial_path)
+        os.replace(partial_path, f'{cache_path}.{data.batch_file_type}')
+    with open(partial_path, 'wb') as f:
+        f.write(output.model_dump_json().encode())
+    os.replace(partial_path, cache_path + '.meta.json')
+
+    now = time.time()
+    cached_files = []
+    for entry in os.scandir(cache_dir):
+        with contextlib.suppress(FileNotFoundError):
+            stat = entry.stat()
+            if now - stat.st_mtime > data.cache_max_age:
+                os.remove(entry.path)
+            elif not entry.name.endswith('.partial'):
+                cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+    cache_size = sum(size for _, size, _ in cached_files)
+    for _, size, path in sorted(cached_files):
+        if cache_size <= data.cache_max_size:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        cache_size -= size
+
 
 @activity.defn
 async def create_artifact_subdirectory(data: CreateArtifactSubdirectoryInput) -> str:
@@ -38,21 +222,23 @@ async def create_artifact_subdirectory(data: CreateArtifactSubdirectoryInput) ->
 
     subdir_path = os.path.join(action_artifacts_dir(), data.subdir_name)
 
-    assert not os.path.exists(subdir_path), (
-        f'Artifact subdirectory "{subdir_path}" already exists.'
-    )
-
-    os.makedirs(subdir_path)
+    try:
+        os.makedirs(subdir_path)
+    except FileExistsError as e:
+        raise AssertionError(
+            f'Artifact subdirectory "{subdir_path}" already exists.'
+        ) from e
 
     return subdir_path
 
 
 @activity.defn
-async def search(data: SearchInput) -> SearchOutput:
+def search(data: SearchInput) -> SearchOutput:
     """
     Activity to perform NOMAD search based on the provided input data. The search
-    results are written to a file in the specified format (Parquet or JSON) in the
-    artifacts directory.
+    results are written to a batch file of `data.batch_file_type` (Parquet, Arrow IPC
+    for CSV output, or JSON) in the artifacts directory. If enabled, the search page
+    is taken from the cache of previous searches with the same input data.
 
     Args:
         data (SearchInput): Input data for the search activity.
@@ -61,12 +247,23 @@ async def search(data: SearchInput) -> SearchOutput:
         SearchOutput: Output data from the search activity.
     """
 
-    write_dataset_file = {
-        'parquet': write_parquet_file,
-        'json': write_json_file,
-    }.get(data.batch_file_type)
+    write_dataset_file = BATCH_FILE_WRITERS.get(data.batch_file_type)
     if write_dataset_file is None:
-        raise ValueError(f'Unsupported batch file type "{data.batch_file_type}". ')
+        raise ValueError(f'Unsupported batch file type "{data.batch_file_type}".')
+
+    # Limit the number of exported entries by fetching at most that many entries
+    data.pagination.page_size = min(
+        data.pagination.page_size, data.max_entries_export_limit
+    )
+
+    cache_path = None
+    if data.cache_max_age > 0:
+        cache_path = os.path.join(
+            action_artifacts_dir(), SEARCH_CACHE_DIR_NAME, _search_cache_key(data)
+        )
+        output = _read_search_cache(cache_path, data)
+        if output is not None:
+            return output
 
     start = datetime.now(timezone.utc).isoformat()
     response = nomad_search(
@@ -79,11 +276,9 @@ async def search(data: SearchInput) -> SearchOutput:
     )
     end = datetime.now(timezone.utc).isoformat()
 
-    # Limit the number of exported entries
-    if len(response.data) > data.max_entries_export_limit:
-        entry_list = response.data[: data.max_entries_export_limit]
-    else:
-        entry_list = response.data
+    # Truncate in place in case the search returned more entries than requested
+    entry_list = response.data
+    del entry_list[data.max_entries_export_limit :]
 
     output = SearchOutput(
         search_start_time=start,
@@ -99,11 +294,75 @@ async def search(data: SearchInput) -> SearchOutput:
     else:
         write_dataset_file(path=data.output_file_path, data=entry_list)
 
+    if cache_path is not None:
+        try:
+            _write_search_cache(cache_path, data, output)
+        except Exception:
+            # the search page is already written, caching it is best effort
+            activity.logger.warning(
+                'Failed to cache the search page "%s".', cache_path, exc_info=True
+            )
+
     return output
 
 
 @activity.defn
-async def merge_output_files(data: MergeOutputFilesInput) -> str | None:
+def search_page_after_values(data: SearchInput) -> list[str]:
+    """
+    Activity to collect the `page_after_value` of the search pages starting at the
+    `page_after_value` of the input pagination, so that the pages can be searched
+    concurrently. Only the entry IDs of the matching entries are fetched, and the
+    values are collected for at most `max_entries_export_limit` entries.
+
+    Args:
+        data (SearchInput): Input data for the search. Its pagination must contain
+            the `page_after_value` of the first page to be collected.
+
+    Returns:
+        list[str]: The `page_after_value` of each search page, starting with the one
+            of the input pagination.
+    """
+
+    if data.pagination.order_by not in (None, 'entry_id'):
+        # the `page_after_value` of a page is the entry ID of the last entry of the
+        # previous page only when ordering by entry ID
+        raise ValueError(
+            f'Unsupported order for collecting search pages "{data.pagination.order_by}".'
+        )
+
+    page_size = data.pagination.page_size
+    page_after_values = [data.pagination.page_after_value]
+    pagination = MetadataPagination(
+        page_size=PAGE_AFTER_VALUES_PAGE_SIZE,
+        page_after_value=data.pagination.page_after_value,
+    )
+    num_entries = 0
+    while pagination.page_after_value is not None:
+        response = nomad_search(
+            user_id=data.user_id,
+            owner=data.owner,
+            query=data.query,
+            required=MetadataRequired(include=['entry_id']),
+            pagination=pagination,
+            aggregations={},
+        )
+        for entry in response.data:
+            num_entries += 1
+            if num_entries >= data.max_entries_export_limit:
+                return page_after_values
+            if num_entries % page_size == 0:
+                page_after_values.append(entry['entry_id'])
+        pagination.page_after_value = response.pagination.next_page_after_value
+
+    if num_entries % page_size == 0 and len(page_after_values) > 1:
+        # the last collected value points past the last entry
+        page_after_values.pop()
+
+    return page_after_values
+
+
+@activity.defn
+def merge_output_files(data: MergeOutputFilesInput) -> str | None:
     """
     Activity to merge multiple batch files into a single file.
 
@@ -121,13 +380,25 @@ async def merge_output_files(data: MergeOutputFilesInput) -> str | None:
         data.artifact_subdirectory, 'data.' + data.output_file_type
     )
 
-    merge_files(data.generated_file_paths, data.output_file_type, merged_file_path)
+    if len(data.generated_file_paths) == 1:
+        file_path = data.generated_file_paths[0]
+        if os.path.splitext(file_path)[1] == f'.{data.output_file_type}':
+            # A single batch file of the output type only needs to be renamed
+            os.replace(file_path, merged_file_path)
+            return merged_file_path
+
+    merge_files(
+        data.generated_file_paths,
+        data.output_file_type,
+        merged_file_path,
+        batch_rows=data.batch_rows,
+    )
 
     return merged_file_path
 
 
 @activity.defn
-async def export_dataset_to_upload(data: ExportDatasetInput) -> str:
+def export_dataset_to_upload(data: ExportDatasetInput) -> str:
     """
     Activity to export the generated dataset files as a zip file to the specified
     upload. A metadata file is also included in the zip.
@@ -140,16 +411,23 @@ async def export_dataset_to_upload(data: ExportDatasetInput) -> str:
 
     def unique_filename(filename: str, upload_files: StagingUploadFiles) -> str:
         """Generate a unique filename for the upload_files directory."""
-        if not upload_files.raw_path_exists(filename):
+        # List the names in the raw directory once instead of checking each candidate
+        # name. `raw_directory_list` is not used, as it also computes the size of each
+        # listed directory by walking it.
+        name, ext = os.path.splitext(filename)
+        raw_dir_path = os.path.dirname(upload_files.raw_file_object(filename).os_path)
+        existing_filenames = {
+            existing_filename
+            for existing_filename in os.listdir(raw_dir_path)
+            if existing_filename.startswith(name)
+        }
+        if filename not in existing_filenames:
             return filename
 
         count = 1
-        while True:
-            name, ext = os.path.splitext(filename)
-            _filename = f'{name}({count}){ext}'
-            if not upload_files.raw_path_exists(_filename):
-                return _filename
+        while f'{name}({count}){ext}' in existing_filenames:
             count += 1
+        return f'{name}({count}){ext}'
 
     upload_files = get_upload_files(data.upload_id, data.user_id)
     if not upload_files:
@@ -157,42 +435,58 @@ async def export_dataset_to_upload(data: ExportDatasetInput) -> str:
             f'Upload with ID {data.upload_id} for user {data.user_id} not found.'
         )
 
-    # Create a metadata.json file in the artifact subdirectory
-    metadata_dict = {
-        'note': 'This metadata file contains information about the exported dataset '
-        'and the conditions under which it was generated.',
-        'data': data.metadata.model_dump(),
-        'schema': data.metadata.model_json_schema(),
-    }
-    metadata_path = os.path.join(data.artifact_subdirectory, 'metadata.json')
-    with open(metadata_path, 'w', encoding='utf-8') as metafile:
-        json.dump(metadata_dict, metafile, indent=4)
-
-    exportable_filepaths = data.source_paths + [metadata_path]
-    exportable_dir_name = unique_filename(data.exportable_dir_name, upload_files)
+    # Serialize the metadata once, it is written as metadata.json next to the
+    # dataset files
+    metadata_json = data.metadata.to_json_bytes()
 
     # Create a zip file containing all the source paths and the metadata file
     if data.zip_output:
-        zipname = exportable_dir_name + '.zip'
-        zippath = os.path.join(data.artifact_subdirectory, zipname)
-        with zipfile.ZipFile(zippath, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-            for filepath in exportable_filepaths:
-                arcname = os.path.basename(filepath)
-                zipf.write(filepath, arcname=arcname)
+        zipname = unique_filename(data.exportable_dir_name + '.zip', upload_files)
+        # Write the zip file directly into the raw directory of the upload, so that
+        # adding it to the upload does not copy the whole archive once more
+        zippath = upload_files.raw_file_object(zipname).os_path
+        partial_zippath = zippath + '.partial'
+        try:
+            _write_zip_file(partial_zippath, data.source_paths, metadata_json)
+            os.replace(partial_zippath, zippath)
+        finally:
+            if os.path.exists(partial_zippath):
+                os.remove(partial_zippath)
         # Add zip file to the NOMAD Upload
         upload_files.add_rawfiles(path=zippath, auto_decompress=False)
         return zipname
 
-    # If not zipping, copy files to directory named exportable_dir_name
-    exportable_dir_path = os.path.join(data.artifact_subdirectory, exportable_dir_name)
+    # If not zipping, link or copy files to directory named exportable_dir_name. The
+    # directory is created directly in the raw directory of the upload, so that adding
+    # it to the upload does not copy the files once more.
+    exportable_dir_name = unique_filename(data.exportable_dir_name, upload_files)
+    exportable_dir_path = upload_files.raw_file_object(exportable_dir_name).os_path
     os.mkdir(exportable_dir_path)
-    for filepath in exportable_filepaths:
-        temp_path = os.path.join(exportable_dir_path, os.path.basename(filepath))
-        shutil.copy2(filepath, temp_path)
-        # Add directory to the NOMAD Upload
-        upload_files.add_rawfiles(
-            path=exportable_dir_path, target_dir=exportable_dir_name
-        )
+    try:
+        # Write the metadata file and link or copy the dataset files concurrently in
+        # separate threads, waiting for all of them before raising any error
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(
+                    pathlib.Path(exportable_dir_path, 'metadata.json').write_bytes,
+                    metadata_json,
+                ),
+                *(
+                    executor.submit(
+                        _link_or_copy,
+                        filepath,
+                        os.path.join(exportable_dir_path, os.path.basename(filepath)),
+                    )
+                    for filepath in data.source_paths
+                ),
+            ]
+        for future in futures:
+            future.result()
+    except BaseException:
+        shutil.rmtree(exportable_dir_path, ignore_errors=True)
+        raise
+    # Add directory to the NOMAD Upload
+    upload_files.add_rawfiles(path=exportable_dir_path, target_dir=exportable_dir_name)
     return exportable_dir_name
 
 
@@ -206,4 +500,6 @@ async def cleanup_artifacts(data: CleanupArtifactsInput) -> None:
     """
 
     if os.path.exists(data.subdir_path):
-        shutil.rmtree(data.subdir_path)
+        # Run in a separate thread to not block the event loop of the worker while
+        # removing the batch files
+        await asyncio.to_thread(shutil.rmtree, data.subdir_path)
@@ -1,15 +1,45 @@
+import functools
 import json
 from typing import Literal
 
+import orjson
 from nomad.app.v1.models.models import MetadataPagination, MetadataRequired, Query
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 OwnerLiteral = Literal['public', 'visible', 'shared', 'user', 'staging']
-BatchFileTypeLiteral = Literal['parquet', 'json']
+BatchFileTypeLiteral = Literal['parquet', 'arrow', 'json']
 OutputFileTypeLiteral = Literal['parquet', 'csv', 'json']
 IndexLiteral = Literal['entries', 'datasets', 'models', 'spaces']
 
 
+def _clean_field(field: str) -> str:
+    """
+    Removes trailing whitespaces and inverted commas
+    """
+    return field.strip().strip("'").strip('"')
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_query(query: str) -> dict:
+    """
+    Parses the query string of the search settings into a dictionary. The workflow
+    code, and with it the parsing, is re-run every time a workflow is replayed, so
+    the parsed queries are cached. The returned dictionary is shared between calls
+    and must not be modified.
+    """
+    return json.loads(_clean_field(query).replace("'", '"'))
+
+
+@functools.cache
+def _json_schema(model: type[BaseModel]) -> dict:
+    """
+    Generates the JSON schema of the given model. The schema does not change at
+    runtime, so it is generated once per model. The returned dictionary is shared
+    between calls and must not be modified.
+    """
+    return model.model_json_schema()
+
+
 class SearchSettings(BaseModel):
     owner: OwnerLiteral = Field(
         'visible', description='Owner of the entries to be searched.'
@@ -82,12 +112,23 @@ class SearchInput(BaseModel):
         ..., description='Pagination settings for the search results.'
     )
     batch_file_type: BatchFileTypeLiteral = Field(
-        ..., description='Type of the output file.'
+        ...,
+        description='Type of the batch file written for each search page. Arrow IPC '
+        'is used for CSV output, and otherwise the type of the output file.',
     )
     output_file_path: str = Field(..., description='Path to the generated output file.')
     max_entries_export_limit: int = Field(
         ..., description='Maximum number of entries to be exported.'
     )
+    cache_max_age: int = Field(
+        0,
+        description='Time (in seconds) for which the search page is cached. The '
+        'output file is taken from the cache if the same search was run within this '
+        'time. 0 disables the cache.',
+    )
+    cache_max_size: int = Field(
+        0, description='Maximum size (in bytes) of the cached search pages.'
+    )
 
     @classmethod
     def from_user_input(
@@ -99,15 +140,7 @@ class SearchInput(BaseModel):
     ) -> 'SearchInput':
         """Convert from ExportEntriesUserInput to SearchInput"""
 
-        def _clean_field(field: str) -> str:
-            """
-            Removes trailing whitespaces and inverted commas
-            """
-            return field.strip().strip("'").strip('"')
-
-        query = json.loads(
-            _clean_field(user_input.search_settings.query).replace("'", '"')
-        )
+        query = _parse_query(user_input.search_settings.query)
 
         required = MetadataRequired()
         if user_input.search_settings.required_include:
@@ -125,9 +158,13 @@ class SearchInput(BaseModel):
 
         pagination = MetadataPagination(page_size=user_input.search_settings.page_size)
 
-        batch_file_type = user_input.output_settings.output_file_type
-        if batch_file_type == 'csv':
-            batch_file_type = 'parquet'  # use parquet batches for csv
+        # Search pages are written as batches of the output type, except for CSV
+        # output, which uses Arrow IPC batches that are cheap to write and read once
+        # when merging. The JSON batches keep the nested structure of the entries,
+        # which is flattened into columns in the Parquet and Arrow IPC batches.
+        batch_file_type = {'parquet': 'parquet', 'csv': 'arrow', 'json': 'json'}[
+            user_input.output_settings.output_file_type
+        ]
 
         return cls(
             user_id=user_input.user_id,
@@ -175,6 +212,12 @@ class MergeOutputFilesInput(BaseModel):
         ...,
         description='List of the generated file paths to be merged into a single file.',
     )
+    batch_rows: int = Field(
+        64 * 1024,
+        gt=0,
+        description='Number of rows of the record batches read from the generated '
+        'files and written to the merged file at once.',
+    )
 
 
 class ExportDatasetMetadata(BaseModel):
@@ -210,6 +253,34 @@ class ExportDatasetMetadata(BaseModel):
         'merging process.',
     )
 
+    _json_bytes: bytes | None = PrivateAttr(None)
+
+    def to_json_bytes(self) -> bytes:
+        """
+        Serializes the metadata, along with a note and its JSON schema, into the
+        content of the metadata file of the exported dataset. The content is computed
+        on first access and cached, so the metadata should not be modified afterwards.
+
+        Returns:
+            bytes: Content of the metadata file.
+        """
+        if self._json_bytes is None:
+            # Dump the fields with the native serializer of pydantic-core instead of
+            # building an intermediate dict. The dumped JSON is indented one more
+            # level to be nested in the file, newlines only appear between tokens.
+            data_json = self.model_dump_json(indent=2).replace('\n', '\n  ')
+            self._json_bytes = orjson.dumps(
+                {
+                    'note': 'This metadata file contains information about the '
+                    'exported dataset and the conditions under which it was '
+                    'generated.',
+                    'data': orjson.Fragment(data_json),
+                    'schema': _json_schema(type(self)),
+                },
+                option=orjson.OPT_INDENT_2,
+            )
+        return self._json_bytes
+
 
 class ExportDatasetInput(BaseModel):
     user_id: str = Field(
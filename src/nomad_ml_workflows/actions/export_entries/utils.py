@@ -1,26 +1,114 @@
-import json
-
-import json_stream
-from nomad.utils import dict_to_dataframe
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import inspect
+import mmap
+import os
+import re
+import tempfile
+from collections.abc import Callable, Iterator
+from typing import BinaryIO
+
+import orjson
 
 try:
     import pyarrow as pa
+    import pyarrow.compute as pc
     import pyarrow.csv as pcsv
     import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
     import pyarrow.parquet as pq
 except ImportError as e:
     raise ImportError(
         'pyarrow is required. Install with: pip install nomad-ml-workflows[cpu-action]'
     ) from e
 
+# Compression of the Parquet batch and merged files, zstd for better compression of
+# the exported file
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 3
+
+# Compression level of the Parquet batch files, which are written for every search page
+# and only read once when merging, so they are compressed faster than the merged file
+BATCH_PARQUET_COMPRESSION_LEVEL = 1
+
+# Compression of the Arrow IPC batch files, which are only read once when merging, lz4
+# for cheap encoding and decoding
+IPC_COMPRESSION = 'lz4'
+
+# Thresholds for coalescing the search pages into row groups of the merged Parquet
+# file, by their uncompressed size in the batch files and by their number of rows.
+# The size is that of the encoded pages, not of the decoded rows buffered in memory.
+MERGED_ROW_GROUP_ROWS = 1024 * 1024
+MERGED_ROW_GROUP_BYTES = 128 * 1024 * 1024
+
+# Number of rows of the record batches read when scanning the batch files, and of the
+# batches written at once, and size of the data pages of the merged Parquet file
+MERGE_BATCH_ROWS = 64 * 1024
+MERGED_DATA_PAGE_BYTES = 2 * 1024 * 1024
+
+# Number of batch files read ahead while the merged Parquet file is written
+MERGE_READ_AHEAD_FILES = 2
+
+# Number of entries flattened and converted to Arrow at once when writing a batch file
+ENTRIES_CHUNK_ROWS = 8192
+
+# Whether the dataset writer can keep the order of the written batches when it encodes
+# them in multiple threads, which needs pyarrow 21 or newer
+_WRITE_DATASET_PRESERVES_ORDER = (
+    'preserve_order' in inspect.signature(ds.write_dataset).parameters
+)
+
+# Buffer size of the merged JSON file, which is written in many small pieces
+MERGED_JSON_BUFFER_SIZE = 1024 * 1024
+
+# Opening bracket of a JSON array and the whitespace around it
+_JSON_ARRAY_START = re.compile(rb'\s*\[\s*')
+
+
+def _fadvise(file: BinaryIO, advice_name: str):
+    """Gives an access pattern advice for a file to the kernel, where supported."""
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    with contextlib.suppress(OSError):
+        os.posix_fadvise(file.fileno(), 0, 0, advice)
+
+
+@contextlib.contextmanager
+def open_sequential(path: str, buffering: int = -1) -> Iterator[BinaryIO]:
+    """Opens a file to be read once sequentially, in binary mode. The kernel is
+    advised to read ahead more aggressively, and to drop the file from the page cache
+    once it has been read, as the batch and dataset files are not read again.
+
+    Args:
+        path (str): Path of the file to be opened.
+        buffering (int): Buffer size of the opened file, as in `open`.
+
+    Yields:
+        BinaryIO: The opened file.
+    """
+    with open(path, 'rb', buffering=buffering) as f:
+        _fadvise(f, 'POSIX_FADV_SEQUENTIAL')
+        try:
+            yield f
+        finally:
+            _fadvise(f, 'POSIX_FADV_DONTNEED')
+
 
 def _is_nested_type(dtype: pa.DataType) -> bool:
     """Check if a PyArrow type is nested."""
     return pa.types.is_nested(dtype)
 
 
+@functools.lru_cache(maxsize=8)
 def _get_csv_compatible_schema(schema: pa.Schema) -> pa.Schema:
-    """Convert schema to CSV-compatible format by changing nested types to strings."""
+    """Convert schema to CSV-compatible format by changing nested types to strings.
+    All the batches scanned from the batch files share the same schema, so the
+    converted schemas are cached.
+    """
     new_fields = []
     for field in schema:
         if _is_nested_type(field.type):
@@ -30,50 +118,208 @@ def _get_csv_compatible_schema(schema: pa.Schema) -> pa.Schema:
     return pa.schema(new_fields)
 
 
+def _primitive_list_to_json(column: pa.Array) -> pa.Array | None:
+    """
+    Encodes a list column of integers, booleans or strings as JSON strings with Arrow
+    compute kernels, in the same form as `orjson`. Floats are left to `orjson`, as
+    Arrow formats their shortest representation differently, e.g. `1e+10` instead of
+    `10000000000.0`.
+
+    Returns:
+        pa.Array | None: The JSON strings, or None if the column holds other values,
+            or strings with control characters, which have to be escaped by `orjson`.
+    """
+    if not (pa.types.is_list(column.type) or pa.types.is_large_list(column.type)):
+        return None
+    values = column.values
+    if pa.types.is_integer(values.type) or pa.types.is_boolean(values.type):
+        strings = pc.cast(values, pa.string())
+    elif pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        if pc.any(pc.match_substring_regex(values, r'[\x00-\x1f]')).as_py():
+            return None
+        # large strings are cast to the string type of the joined separators
+        escaped = pc.replace_substring(
+            pc.replace_substring(pc.cast(values, pa.string()), '\\', '\\\\'),
+            '"',
+            '\\"',
+        )
+        strings = pc.binary_join_element_wise('"', escaped, '"', '')
+    else:
+        return None
+
+    # The offsets of the column index into all of its values, also when it is sliced
+    lists = type(column).from_arrays(column.offsets, pc.fill_null(strings, 'null'))
+    joined = pc.binary_join_element_wise('[', pc.binary_join(lists, ','), ']', '')
+    return pc.if_else(column.is_valid(), joined, pa.scalar(None, pa.string()))
+
+
 def _stringify_nested_columns(batch: pa.RecordBatch) -> pa.RecordBatch:
     """Convert nested columns (list, struct) in a batch to JSON strings."""
+    schema = batch.schema
+    nested_mask = [_is_nested_type(field.type) for field in schema]
+    if not any(nested_mask):
+        # The batch is already CSV compatible
+        return batch
+
     new_columns = []
-    for i, column in enumerate(batch.columns):
-        if _is_nested_type(batch.schema.field(i).type):
-            # Convert each element to JSON string
-            stringified = pa.array(
-                [
-                    json.dumps(val.as_py()) if val.as_py() is not None else None
-                    for val in column
-                ],
-                type=pa.string(),
-            )
+    for column, is_nested in zip(batch.columns, nested_mask):
+        if is_nested:
+            stringified = _primitive_list_to_json(column)
+            if stringified is None:
+                # Convert the column to Python objects in one go, instead of boxing
+                # every element as an Arrow scalar, and encode them to JSON strings
+                stringified = pa.array(
+                    [
+                        orjson.dumps(value).decode() if value is not None else None
+                        for value in column.to_pylist()
+                    ],
+                    type=pa.string(),
+                )
             new_columns.append(stringified)
         else:
             new_columns.append(column)
 
     return pa.RecordBatch.from_arrays(
-        new_columns, schema=_get_csv_compatible_schema(batch.schema)
+        new_columns, schema=_get_csv_compatible_schema(schema)
     )
 
 
-def write_parquet_file(path: str, data: list[dict]):
+def _flatten_entry(
+    value, parent_key: str = '', items: dict | None = None, sep: str = '.'
+) -> dict:
+    """
+    Flattens a nested NOMAD entry dict into a flat dict with the keys combined by
+    `sep`, in the same way as `nomad.utils.dict_to_dataframe`. Lists of dicts are
+    flattened using the list indices as keys, other lists are kept as values.
+    """
+    if items is None:
+        items = {}
+    if isinstance(value, dict):
+        for key, sub_value in value.items():
+            new_key = f'{parent_key}{sep}{key}' if parent_key else key
+            if isinstance(sub_value, dict | list):
+                _flatten_entry(sub_value, new_key, items, sep)
+            else:
+                items[new_key] = sub_value
+    elif isinstance(value, list) and all(isinstance(item, dict) for item in value):
+        for index, item in enumerate(value):
+            new_key = f'{parent_key}{sep}{index}' if parent_key else str(index)
+            _flatten_entry(item, new_key, items, sep)
+    else:
+        items[parent_key] = value
+    return items
+
+
+def _entries_chunk_to_table(data: list[dict]) -> pa.Table:
+    """
+    Converts a list of NOMAD entry dicts into a table with one column per flattened
+    key, sorted alphabetically. The entries are flattened directly into one list per
+    column, and each list is released once it is converted, so that pyarrow converts
+    each column at once and the flattened rows are never held all together.
+    """
+    columns: dict[str, list] = {}
+    for index, entry in enumerate(data):
+        for key, value in _flatten_entry(entry).items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = [None] * index
+            column.append(value)
+        for column in columns.values():
+            if len(column) == index:
+                column.append(None)
+
+    names = sorted(columns)
+    return pa.Table.from_arrays([pa.array(columns.pop(name)) for name in names], names)
+
+
+def _entries_to_table(data: list[dict]) -> pa.Table:
+    """
+    Converts a list of NOMAD entry dicts into a table with one column per flattened
+    key, sorted alphabetically. The entries are converted in chunks of
+    `ENTRIES_CHUNK_ROWS`, so that the flattened Python values of only one chunk are
+    held at once. The chunks are concatenated with their missing columns filled with
+    nulls and their types promoted, as when converting all the entries at once.
+    """
+    if len(data) <= ENTRIES_CHUNK_ROWS:
+        return _entries_chunk_to_table(data)
+
+    table = pa.concat_tables(
+        [
+            _entries_chunk_to_table(data[start : start + ENTRIES_CHUNK_ROWS])
+            for start in range(0, len(data), ENTRIES_CHUNK_ROWS)
+        ],
+        promote_options='permissive',
+    )
+    return table.select(sorted(table.column_names))
+
+
+def _encode_csv(
+    data: pa.RecordBatch | pa.Table, include_header: bool = False
+) -> pa.Buffer:
+    """Encodes data without nested columns as CSV."""
+    sink = pa.BufferOutputStream()
+    pcsv.write_csv(
+        data, sink, write_options=pcsv.WriteOptions(include_header=include_header)
+    )
+    return sink.getvalue()
+
+
+def _encode_csv_batch(batch: pa.RecordBatch) -> pa.Buffer:
+    """Encodes a batch as CSV, with its nested columns converted to JSON strings."""
+    return _encode_csv(_stringify_nested_columns(batch))
+
+
+def write_parquet_file(
+    path: str,
+    data: list[dict],
+    compression: str = PARQUET_COMPRESSION,
+    compression_level: int | None = BATCH_PARQUET_COMPRESSION_LEVEL,
+):
     """Writes a list of NOMAD entry dicts to a parquet file.
 
     Args:
         path (str): The path where the file will be saved.
         data (list[dict]): The list of NOMAD entry dicts to be written to the file.
+        compression (str): The compression codec of the file. Defaults to the codec
+            of the merged file, so that a single batch file can be exported as is.
+        compression_level (int | None): The compression level of the codec. Defaults
+            to the faster level of the batch files.
     """
     if not path.endswith('parquet'):
         raise ValueError('Unsupported file type. Please use parquet.')
 
-    df = dict_to_dataframe(data)
-
-    table = pa.Table.from_pandas(df)
+    table = _entries_to_table(data)
     with pq.ParquetWriter(
         path,
         table.schema,
-        compression='snappy',  # snappy for faster write/read for individual files
+        compression=compression,
+        compression_level=compression_level,
         use_dictionary=True,
     ) as writer:
         writer.write_table(table)
 
 
+def write_arrow_file(path: str, data: list[dict]):
+    """Writes a list of NOMAD entry dicts to an Arrow IPC file. The Arrow buffers are
+    written as they are in memory, without Parquet encoding, so the file is cheap to
+    write and to read again when it is only an intermediate batch file.
+
+    Args:
+        path (str): The path where the file will be saved.
+        data (list[dict]): The list of NOMAD entry dicts to be written to the file.
+    """
+    if not path.endswith('arrow'):
+        raise ValueError('Unsupported file type. Please use arrow.')
+
+    table = _entries_to_table(data)
+    with pa.ipc.new_file(
+        path,
+        table.schema,
+        options=pa.ipc.IpcWriteOptions(compression=IPC_COMPRESSION),
+    ) as writer:
+        writer.write_table(table)
+
+
 def write_csv_file(path: str, data: list[dict]):
     """Writes a list of NOMAD entry dicts to a CSV file.
 
@@ -84,9 +330,13 @@ def write_csv_file(path: str, data: list[dict]):
     if not path.endswith('csv'):
         raise ValueError('Unsupported file type. Please use csv.')
 
-    df = dict_to_dataframe(data)
+    table = _entries_to_table(data)
 
-    df.to_csv(path, index=False, mode='w', header=True)
+    # PyArrow CSV writer doesn't support nested types (list, struct, etc.)
+    # Convert nested columns to JSON strings
+    with pcsv.CSVWriter(path, _get_csv_compatible_schema(table.schema)) as writer:
+        for batch in table.to_batches():
+            writer.write_batch(_stringify_nested_columns(batch))
 
 
 def write_json_file(path: str, data: list[dict]):
@@ -99,74 +349,439 @@ def write_json_file(path: str, data: list[dict]):
     if not path.endswith('json'):
         raise ValueError('Unsupported file type. Please use json.')
 
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=4)
+    with open(path, 'wb') as f:
+        f.write(
+            orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+        )
+
+
+def _merged_row_group_rows(metadatas: list[pq.FileMetaData]) -> int:
+    """Estimates the number of rows of the merged row groups from the footers of the
+    input files, so that they hold about `MERGED_ROW_GROUP_BYTES` uncompressed bytes,
+    and at most `MERGED_ROW_GROUP_ROWS` rows. The uncompressed bytes are those of the
+    encoded Parquet pages: the decoded rows of a row group, which are buffered while
+    merging, can take several times more memory, e.g. for dictionary encoded strings.
+    """
+    num_rows = sum(metadata.num_rows for metadata in metadatas)
+    num_bytes = sum(
+        metadata.row_group(index).total_byte_size
+        for metadata in metadatas
+        for index in range(metadata.num_row_groups)
+    )
+    if num_rows == 0 or num_bytes == 0:
+        return MERGED_ROW_GROUP_ROWS
+    return max(
+        1, min(MERGED_ROW_GROUP_ROWS, MERGED_ROW_GROUP_BYTES * num_rows // num_bytes)
+    )
+
+
+def _read_row_groups(path: str, metadata: pq.FileMetaData) -> list[pa.Table]:
+    """Reads the row groups of a Parquet file, using its already read footer. The file
+    is memory-mapped, so that its pages are decoded straight from the page cache, and
+    is only opened to drop it from the page cache once it is read.
+    """
+    with (
+        open_sequential(path),
+        pq.ParquetFile(path, metadata=metadata, memory_map=True) as parquet_file,
+    ):
+        return [
+            parquet_file.read_row_group(index)
+            for index in range(parquet_file.num_row_groups)
+        ]
+
+
+def _read_row_groups_ahead(
+    input_file_paths: list[str], metadatas: list[pq.FileMetaData]
+) -> Iterator[pa.Table]:
+    """Yields the row groups of Parquet files, in order. The files are read in a
+    background thread, up to `MERGE_READ_AHEAD_FILES` files ahead, so that they are
+    decoded while the previous row groups are encoded by the caller.
+    """
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        pending: collections.deque[concurrent.futures.Future] = collections.deque()
+        for path, metadata in zip(input_file_paths, metadatas):
+            pending.append(executor.submit(_read_row_groups, path, metadata))
+            if len(pending) > MERGE_READ_AHEAD_FILES:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _write_parquet_row_groups(
+    tables: Iterator[pa.Table],
+    schema: pa.Schema,
+    output_file_path: str,
+    row_group_rows: int,
+    batch_rows: int = MERGE_BATCH_ROWS,
+):
+    """Writes tables with the same schema to a single Parquet file with one writer, in
+    order. Consecutive tables are coalesced into row groups of `row_group_rows` rows,
+    avoiding many small row groups in the merged file.
+
+    Args:
+        tables (Iterator[pa.Table]): The tables to be written, in order.
+        schema (pa.Schema): The schema shared by all the tables.
+        output_file_path (str): Path of the merged output file.
+        row_group_rows (int): Number of rows of the written row groups.
+        batch_rows (int): Number of rows encoded at once.
+    """
+    with pq.ParquetWriter(
+        output_file_path,
+        schema,
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        use_dictionary=True,
+        write_batch_size=batch_rows,
+        data_page_size=MERGED_DATA_PAGE_BYTES,
+    ) as writer:
+        buffer: list[pa.Table] = []
+        buffered_rows = 0
+        for table in tables:
+            buffer.append(table)
+            buffered_rows += table.num_rows
+            if buffered_rows >= row_group_rows:
+                # Write the full row groups, and keep the remaining rows buffered
+                buffered = pa.concat_tables(buffer)
+                full_rows = buffered_rows - buffered_rows % row_group_rows
+                writer.write_table(
+                    buffered.slice(0, full_rows), row_group_size=row_group_rows
+                )
+                buffer = [buffered.slice(full_rows)]
+                buffered_rows -= full_rows
+        if buffered_rows:
+            writer.write_table(pa.concat_tables(buffer), row_group_size=row_group_rows)
+
+
+def _append_parquet_row_groups(
+    input_file_paths: list[str],
+    metadatas: list[pq.FileMetaData],
+    schema: pa.Schema,
+    output_file_path: str,
+    batch_rows: int = MERGE_BATCH_ROWS,
+):
+    """Appends the row groups of Parquet files with identical schemas to a single
+    Parquet file. Each batch file holds a single search page, so the row groups of
+    consecutive batch files are coalesced into row groups of about
+    `MERGED_ROW_GROUP_BYTES` bytes, avoiding many small row groups in the merged
+    file. The row groups are decoded and encoded again, as pyarrow cannot copy
+    their compressed pages as is, but the footers already read from the input files
+    are reused instead of being parsed again. The next files are read while the
+    coalesced row groups are written.
+
+    Args:
+        input_file_paths (list[str]): List of Parquet file paths to be merged.
+        metadatas (list[pq.FileMetaData]): The footer metadata of the input files.
+        schema (pa.Schema): The schema shared by all the input files.
+        output_file_path (str): Path of the merged output file.
+        batch_rows (int): Number of rows encoded at once.
+    """
+    _write_parquet_row_groups(
+        _read_row_groups_ahead(input_file_paths, metadatas),
+        schema,
+        output_file_path,
+        _merged_row_group_rows(metadatas),
+        batch_rows,
+    )
+
+
+def _write_parquet_dataset(
+    scanner: ds.Scanner,
+    output_file_path: str,
+    row_group_rows: int,
+    batch_rows: int = MERGE_BATCH_ROWS,
+):
+    """Writes the batches of a scanner to a single Parquet file with the dataset
+    writer, which encodes them in multiple threads while preserving their order.
+    Versions of pyarrow whose dataset writer cannot preserve the order write the
+    batches with a single writer instead.
+
+    Args:
+        scanner (ds.Scanner): Scanner yielding the batches to be written, in order.
+        output_file_path (str): Path of the merged output file.
+        row_group_rows (int): Number of rows of the written row groups.
+        batch_rows (int): Number of rows encoded at once.
+    """
+    if not _WRITE_DATASET_PRESERVES_ORDER:
+        _write_parquet_row_groups(
+            (pa.Table.from_batches([batch]) for batch in scanner.to_batches()),
+            scanner.projected_schema,
+            output_file_path,
+            row_group_rows,
+            batch_rows,
+        )
+        return
+
+    # The dataset writer writes into a directory, so a single part file is written
+    # into a temporary directory next to the output file, and renamed into place
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file_path)) as tmp_dir:
+        written_file_paths = []
+        ds.write_dataset(
+            scanner,
+            base_dir=tmp_dir,
+            basename_template='part-{i}.parquet',
+            format='parquet',
+            file_options=ds.ParquetFileFormat().make_write_options(
+                compression=PARQUET_COMPRESSION,
+                compression_level=PARQUET_COMPRESSION_LEVEL,
+                use_dictionary=True,
+                write_batch_size=batch_rows,
+                data_page_size=MERGED_DATA_PAGE_BYTES,
+            ),
+            use_threads=True,
+            preserve_order=True,
+            # coalesce the search pages into row groups of the same size as
+            # when appending them. As there, up to one row group of decoded rows
+            # is buffered, see `_merged_row_group_rows` for its size in memory.
+            min_rows_per_group=row_group_rows,
+            max_rows_per_group=row_group_rows,
+            file_visitor=lambda file: written_file_paths.append(file.path),
+        )
+        if len(written_file_paths) != 1:
+            raise ValueError(
+                f'Expected a single merged file, got {len(written_file_paths)}.'
+            )
+        os.replace(written_file_paths[0], output_file_path)
+
+
+@contextlib.contextmanager
+def _map_file(file: BinaryIO) -> Iterator[mmap.mmap | bytes]:
+    """Memory-maps a file opened for reading. Empty files, which cannot be mapped,
+    are yielded as empty bytes."""
+    if os.fstat(file.fileno()).st_size == 0:
+        yield b''
+        return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        yield content
+
+
+def _json_array_elements_span(content: mmap.mmap | bytes) -> tuple[int, int] | None:
+    """Finds the elements of the JSON array held by `content`, without the enclosing
+    brackets and surrounding whitespace.
+
+    Args:
+        content (mmap.mmap | bytes): The content of a JSON file.
+
+    Returns:
+        tuple[int, int] | None: The start and end offsets of the elements, equal if
+            the array is empty, or None if the content is not a JSON array.
+    """
+    start = _JSON_ARRAY_START.match(content)
+    end = content.rfind(b']')
+    if start is None or end < start.end() - 1 or content[end + 1 :].strip():
+        return None
+    while end > start.end() and content[end - 1 : end].isspace():
+        end -= 1
+    return start.end(), end
+
+
+def _read_arrow_schema(path: str) -> pa.Schema:
+    """Reads the schema of an Arrow IPC file."""
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def _coalesce_batches(
+    batches: Iterator[pa.RecordBatch], num_rows: int
+) -> Iterator[pa.RecordBatch]:
+    """Combines consecutive record batches with the same schema into batches of at
+    least `num_rows` rows, except for the last one. The batches scanned from the
+    batch files hold at most one search page each, which is too small for the compute
+    kernels to amortize their per call overhead.
+    """
+    buffer: list[pa.RecordBatch] = []
+    buffered_rows = 0
+    for batch in batches:
+        buffer.append(batch)
+        buffered_rows += batch.num_rows
+        if buffered_rows >= num_rows:
+            yield from pa.Table.from_batches(buffer).combine_chunks().to_batches()
+            buffer = []
+            buffered_rows = 0
+    if buffer:
+        yield from pa.Table.from_batches(buffer).combine_chunks().to_batches()
+
+
+def _sendfile(source: BinaryIO, output: BinaryIO, start: int, end: int) -> bool:
+    """Copies the bytes from `start` to `end` of `source` to the current position of
+    `output` with `os.sendfile`, so that they are copied by the kernel without passing
+    through user space. The buffer of `output` is flushed first.
+
+    Returns:
+        bool: Whether the bytes were copied, False if `os.sendfile` is not supported
+            for these files, in which case nothing was copied.
+    """
+    if not hasattr(os, 'sendfile'):
+        return False
+    output.flush()
+    offset = start
+    while offset < end:
+        try:
+            sent = os.sendfile(output.fileno(), source.fileno(), offset, end - offset)
+        except OSError as e:
+            if offset == start and e.errno in (
+                errno.EINVAL,
+                errno.ENOSYS,
+                errno.ENOTSOCK,
+                errno.EOPNOTSUPP,
+            ):
+                return False
+            raise
+        if sent == 0:
+            raise OSError(f'Unexpected end of file "{source.name}".')
+        offset += sent
+    return True
+
+
+def _scan_batch_files(
+    input_file_paths: list[str],
+    schemas: list[pa.Schema],
+    batch_rows: int = MERGE_BATCH_ROWS,
+    file_format: ds.FileFormat | None = None,
+    memory_map: bool = False,
+) -> ds.Scanner:
+    """Creates a scanner over the batch files as a single logical dataset, not
+    loading all data into memory. The schemas read from the files are unified, as the
+    dataset otherwise only uses the schema of the first file. The files are decoded
+    in multiple threads.
+
+    Args:
+        input_file_paths (list[str]): List of batch file paths to be scanned.
+        schemas (list[pa.Schema]): The schemas of the input files.
+        batch_rows (int): Maximum number of rows of the yielded record batches.
+        file_format (ds.FileFormat | None): The format of the batch files. Defaults
+            to Parquet, with the column chunks of the files read ahead.
+        memory_map (bool): Whether the files are memory-mapped instead of read into
+            buffers. This pays off for formats that are not read ahead.
+
+    Returns:
+        ds.Scanner: Scanner yielding the record batches of the files, in order.
+    """
+    if file_format is None:
+        file_format = ds.ParquetFileFormat(
+            default_fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=True)
+        )
+    dataset = ds.dataset(
+        input_file_paths,
+        format=file_format,
+        schema=pa.unify_schemas(schemas, promote_options='permissive'),
+        filesystem=pafs.LocalFileSystem(use_mmap=memory_map),
+    )
+    return dataset.scanner(batch_size=batch_rows, use_threads=True)
+
+
+def _merge_parquet(input_file_paths: list[str], output_file_path: str, batch_rows: int):
+    """Merges Parquet batch files into a single Parquet file."""
+    metadatas = [pq.read_metadata(path) for path in input_file_paths]
+    schemas = [metadata.schema.to_arrow_schema() for metadata in metadatas]
+    if all(schema.equals(schemas[0]) for schema in schemas[1:]):
+        # All the batch files share the same schema: append their row groups to
+        # a single writer, one batch file at a time, without scanning the files
+        # as a dataset.
+        _append_parquet_row_groups(
+            input_file_paths, metadatas, schemas[0], output_file_path, batch_rows
+        )
+        return
+
+    # The batch files have differing schemas: scan them as a dataset, which casts
+    # their batches to the unified schema
+    _write_parquet_dataset(
+        _scan_batch_files(input_file_paths, schemas, batch_rows),
+        output_file_path,
+        _merged_row_group_rows(metadatas),
+        batch_rows,
+    )
+
+
+def _merge_csv(input_file_paths: list[str], output_file_path: str, batch_rows: int):
+    """Merges Arrow IPC batch files into a single CSV file."""
+    # The batch files for `csv` are written in Arrow IPC format, as they are
+    # only read once here and do not need to be encoded as Parquet.
+    scanner = _scan_batch_files(
+        input_file_paths,
+        [_read_arrow_schema(path) for path in input_file_paths],
+        batch_rows,
+        file_format=ds.IpcFileFormat(),
+        memory_map=True,
+    )
+
+    # PyArrow CSV writer doesn't support nested types (list, struct, etc.)
+    # Convert nested columns to JSON strings
+    csv_schema = _get_csv_compatible_schema(scanner.projected_schema)
+
+    # Write the header once, then append the CSV encoded rows of the batches.
+    # The nested columns of the batches are stringified and the batches encoded
+    # in a thread pool, keeping a bounded number of them in flight, and their
+    # bytes are appended in order.
+    max_workers = os.cpu_count() or 1
+    with (
+        open(output_file_path, 'wb') as f,
+        concurrent.futures.ThreadPoolExecutor(max_workers) as executor,
+    ):
+        f.write(_encode_csv(csv_schema.empty_table(), include_header=True))
+        pending: collections.deque[concurrent.futures.Future] = collections.deque()
+        for batch in _coalesce_batches(scanner.to_batches(), batch_rows):
+            pending.append(executor.submit(_encode_csv_batch, batch))
+            if len(pending) > 2 * max_workers:
+                f.write(pending.popleft().result())
+        while pending:
+            f.write(pending.popleft().result())
+
+
+def _merge_json(input_file_paths: list[str], output_file_path: str, batch_rows: int):
+    """Merges JSON batch files into a single JSON file. The batch files are not
+    decoded, so `batch_rows` is not used."""
+    # Each batch file holds a JSON array of entry dicts: splice the elements of
+    # the arrays into a single array instead of parsing and serializing them again.
+    # The batch files are memory-mapped to find the elements, which are copied by the
+    # kernel, or else written from the mapping without being copied first.
+    with open(output_file_path, 'wb', buffering=MERGED_JSON_BUFFER_SIZE) as f:
+        f.write(b'[')
+        first_file = True
+        for file_path in input_file_paths:
+            with (
+                open_sequential(file_path) as batch_file,
+                _map_file(batch_file) as content,
+            ):
+                span = _json_array_elements_span(content)
+                if span is None:
+                    raise ValueError(f'File "{file_path}" does not hold a JSON array.')
+                start, end = span
+                if start == end:
+                    continue
+                f.write(b'\n  ' if first_file else b',\n  ')
+                if not _sendfile(batch_file, f, start, end):
+                    with memoryview(content) as view:
+                        f.write(view[start:end])
+                first_file = False
+        f.write(b'\n]' if not first_file else b']')
+
+
+# Functions merging the batch files into a merged file, by the type of the merged file
+_MERGERS: dict[str, Callable[[list[str], str, int], None]] = {
+    'parquet': _merge_parquet,
+    'csv': _merge_csv,
+    'json': _merge_json,
+}
 
 
 def merge_files(
-    input_file_paths: list[str], output_file_type: str, output_file_path: str
+    input_file_paths: list[str],
+    output_file_type: str,
+    output_file_path: str,
+    batch_rows: int = MERGE_BATCH_ROWS,
 ):
-    """Merges multiple Parquet or JSON files into a single file.
+    """Merges multiple Parquet, Arrow IPC or JSON batch files into a single file.
 
     Args:
         input_file_paths (list[str]): List of file paths to be merged.
         output_file_type (str): The type of the output file ('parquet', 'csv', or
             'json').
         output_file_path (str): Path of the merged output file.
+        batch_rows (int): Number of rows of the record batches read from the batch
+            files and written at once. Smaller batches use less memory for inputs
+            with many columns.
     """
-    if output_file_type == 'parquet':
-        # Creates a logical dataset from the input files, not loading all data into
-        # memory. Also, unifies the schema across the files.
-        dataset = ds.dataset(input_file_paths, format='parquet')
-
-        # Write the dataset to a single Parquet file in batches
-        with pq.ParquetWriter(
-            output_file_path,
-            dataset.schema,
-            compression='zstd',  # for better compression for merged file
-            compression_level=3,
-            use_dictionary=True,
-        ) as writer:
-            for batch in dataset.to_batches():
-                writer.write_batch(batch)
-
-    elif output_file_type == 'csv':
-        # Creates a logical dataset from the input files, not loading all data into
-        # memory. Also, unifies the schema across the files.
-        # The batch files for `csv` are written in Parquet format for efficiency,
-        # so we read them as Parquet here.
-        dataset = ds.dataset(input_file_paths, format='parquet')
-
-        # PyArrow CSV writer doesn't support nested types (list, struct, etc.)
-        # Convert nested columns to JSON strings
-        csv_schema = _get_csv_compatible_schema(dataset.schema)
-
-        # Write the dataset to a single CSV file in batches
-        with pcsv.CSVWriter(output_file_path, csv_schema) as writer:
-            for batch in dataset.to_batches():
-                csv_batch = _stringify_nested_columns(batch)
-                writer.write_batch(csv_batch)
-
-    elif output_file_type == 'json':
-
-        def _json_stream_files(input_file_paths):
-            """Generator that streams one entry dict at a time from multiple files."""
-            for file_path in input_file_paths:
-                with open(file_path, encoding='utf-8') as f:
-                    data = json_stream.load(f)
-                    yield from data
-
-        # Write a single JSON file by streaming entry dicts and wrapping in a list
-        with open(output_file_path, 'w', encoding='utf-8') as f:
-            f.write('[\n')
-            first_item = True
-            for item in _json_stream_files(input_file_paths):
-                if not first_item:
-                    f.write(',\n')
-                # Convert transient json_stream object to standard Python types
-                json.dump(json_stream.to_standard_types(item), f, indent=4)
-                first_item = False
-            f.write('\n]')
-
-    else:
+    merge = _MERGERS.get(output_file_type)
+    if merge is None:
         raise ValueError('Unsupported file type. Please use parquet, csv, or json.')
+    merge(input_file_paths, output_file_path, batch_rows)
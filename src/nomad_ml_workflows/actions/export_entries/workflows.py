@@ -1,3 +1,5 @@
+import asyncio
+import math
 from datetime import timedelta
 
 from temporalio import workflow
@@ -8,11 +10,13 @@ with workflow.unsafe.imports_passed_through():
     from nomad.config import config as nomad_config
 
     from nomad_ml_workflows.actions.export_entries.activities import (
+        SEARCH_MAX_RESULT_WINDOW,
         cleanup_artifacts,
         create_artifact_subdirectory,
         export_dataset_to_upload,
         merge_output_files,
         search,
+        search_page_after_values,
     )
     from nomad_ml_workflows.actions.export_entries.models import (
         CleanupArtifactsInput,
@@ -22,6 +26,7 @@ with workflow.unsafe.imports_passed_through():
         ExportEntriesUserInput,
         MergeOutputFilesInput,
         SearchInput,
+        SearchOutput,
     )
 
 
@@ -65,57 +70,147 @@ class ExportEntriesWorkflow:
                 'nomad_ml_workflows.actions:export_entries'
             )
 
-            search_counter = 0
-            num_entries_available = 0
-            generated_file_paths = []
-            search_start_times = []
-            search_end_times = []
-            total_num_entries_exported = 0
-            reached_max_entries_limit = False
             search_input = SearchInput.from_user_input(
                 data,
-                output_file_path='',  # Placeholder, will be set in loop
+                output_file_path='',  # Placeholder, will be set for each page
                 max_entries_export_limit=config.max_entries_export_limit,
             )
-            while True:
-                search_counter += 1
-                search_input.output_file_path = (
-                    f'{artifact_subdirectory}/{search_counter}.'
-                    f'{search_input.batch_file_type}'
+            search_input.cache_max_age = config.search_cache_max_age
+            search_input.cache_max_size = config.search_cache_max_size
+            page_size = search_input.pagination.page_size
+            # Batch files are named after the page number within the subdirectory
+            batch_file_path_prefix = f'{artifact_subdirectory}/'
+            batch_file_path_suffix = f'.{search_input.batch_file_type}'
+
+            def page_search_input(
+                page_number: int, max_entries: int, **pagination
+            ) -> SearchInput:
+                """
+                Creates the search input for the given (1-based) page number, with
+                the given `pagination` fields. The page size is reduced to
+                `max_entries`, so that the last page only fetches the remaining
+                entries.
+                """
+                return search_input.model_copy(
+                    update={
+                        'pagination': search_input.pagination.model_copy(
+                            update={
+                                **pagination,
+                                'page_size': min(page_size, max_entries),
+                            }
+                        ),
+                        'output_file_path': (
+                            batch_file_path_prefix
+                            + str(page_number)
+                            + batch_file_path_suffix
+                        ),
+                        'max_entries_export_limit': max_entries,
+                    }
                 )
-                search_output = await workflow.execute_activity(
+
+            async def execute_search(
+                page_number: int, page_input: SearchInput
+            ) -> SearchOutput:
+                return await workflow.execute_activity(
                     search,
-                    search_input,
-                    activity_id=f'search-activity-{search_counter}',
+                    page_input,
+                    activity_id=f'search-activity-{page_number}',
                     start_to_close_timeout=timedelta(
                         seconds=config.search_batch_timeout
                     ),
                     retry_policy=retry_policy,
                 )
-                if search_counter == 1:
-                    # capture the total available entries from the first search output
-                    num_entries_available = search_output.num_entries_available
-                if search_output.num_entries_exported > 0:
-                    # only save paths if the writing files was not skipped
-                    generated_file_paths.append(search_input.output_file_path)
-                search_start_times.append(search_output.search_start_time)
-                search_end_times.append(search_output.search_end_time)
-                total_num_entries_exported += search_output.num_entries_exported
-                # Update pagination for next iteration
-                search_input.pagination.page_after_value = (
-                    search_output.pagination_next_page_after_value
-                )
-                search_input.max_entries_export_limit -= (
-                    search_output.num_entries_exported
-                )
 
-                if search_output.pagination_next_page_after_value is None:
-                    # break if there are no more pages to fetch
-                    break
-                if search_input.max_entries_export_limit <= 0:
-                    # break early if the max entries limit has been reached
-                    reached_max_entries_limit = True
-                    break
+            # Search the first page to get the total number of available entries
+            page_inputs = [page_search_input(1, config.max_entries_export_limit)]
+            search_outputs = [await execute_search(1, page_inputs[0])]
+            num_entries_available = search_outputs[0].num_entries_available
+            num_entries_to_export = min(
+                num_entries_available, config.max_entries_export_limit
+            )
+            remaining_entries = (
+                config.max_entries_export_limit - search_outputs[0].num_entries_exported
+            )
+
+            next_page_after_value = search_outputs[0].pagination_next_page_after_value
+            if next_page_after_value is not None and remaining_entries > 0:
+                if num_entries_to_export < SEARCH_MAX_RESULT_WINDOW:
+                    # All the pages are within the result window of the search, so
+                    # they can be addressed by their offset and searched concurrently.
+                    # The offset plus the page size of the last page is the number of
+                    # exported entries, which has to be smaller than the window.
+                    remaining_page_inputs = [
+                        page_search_input(
+                            page_number,
+                            num_entries_to_export - (page_number - 1) * page_size,
+                            page_offset=(page_number - 1) * page_size,
+                        )
+                        for page_number in range(
+                            2, math.ceil(num_entries_to_export / page_size) + 1
+                        )
+                    ]
+                else:
+                    # Collect the cursors of the remaining pages, so that they can be
+                    # searched concurrently
+                    page_after_values = await workflow.execute_activity(
+                        search_page_after_values,
+                        page_search_input(
+                            2, remaining_entries, page_after_value=next_page_after_value
+                        ),
+                        start_to_close_timeout=timedelta(
+                            seconds=config.search_batch_timeout
+                        ),
+                        retry_policy=retry_policy,
+                    )
+                    remaining_page_inputs = [
+                        page_search_input(
+                            page_number,
+                            remaining_entries - (page_number - 2) * page_size,
+                            page_after_value=page_after_value,
+                        )
+                        for page_number, page_after_value in enumerate(
+                            page_after_values, start=2
+                        )
+                    ]
+                for start in range(
+                    0, len(remaining_page_inputs), config.max_concurrent_searches
+                ):
+                    batch = remaining_page_inputs[
+                        start : start + config.max_concurrent_searches
+                    ]
+                    results = await asyncio.gather(
+                        *(
+                            execute_search(start + index + 2, page_input)
+                            for index, page_input in enumerate(batch)
+                        ),
+                        return_exceptions=True,
+                    )
+                    # Raise the first error only once all the searches of the batch
+                    # have finished, so that none of them still writes its batch file
+                    # while the artifacts are exported and cleaned up
+                    for result in results:
+                        if isinstance(result, BaseException):
+                            raise result
+                    search_outputs.extend(results)
+                page_inputs.extend(remaining_page_inputs)
+
+            generated_file_paths = [
+                page_input.output_file_path
+                for page_input, search_output in zip(page_inputs, search_outputs)
+                # only save paths if the writing files was not skipped
+                if search_output.num_entries_exported > 0
+            ]
+            total_num_entries_exported = sum(
+                search_output.num_entries_exported for search_output in search_outputs
+            )
+            reached_max_entries_limit = (
+                total_num_entries_exported >= config.max_entries_export_limit
+                and num_entries_available > total_num_entries_exported
+            )
+            search_start_time = search_outputs[0].search_start_time
+            search_end_time = max(
+                search_output.search_end_time for search_output in search_outputs
+            )
 
             merged_file_path = await workflow.execute_activity(
                 merge_output_files,
@@ -123,6 +218,7 @@ class ExportEntriesWorkflow:
                     artifact_subdirectory=artifact_subdirectory,
                     output_file_type=data.output_settings.output_file_type,
                     generated_file_paths=generated_file_paths,
+                    batch_rows=config.merge_batch_rows,
                 ),
                 start_to_close_timeout=timedelta(hours=2),
                 retry_policy=retry_policy,
@@ -130,15 +226,15 @@ class ExportEntriesWorkflow:
 
             # Prepare export dataset input and metadata
             export_dataset_input.exportable_dir_name = (
-                'export_entries_' + search_start_times[0].replace(':', '-')
+                'export_entries_' + search_start_time.replace(':', '-')
             )
             export_dataset_input.source_paths = [merged_file_path]
             export_dataset_input.metadata = ExportDatasetMetadata(
                 num_entries_exported=total_num_entries_exported,
                 num_entries_available=num_entries_available,
                 reached_max_entries_limit=reached_max_entries_limit,
-                search_start_time=search_start_times[0],
-                search_end_time=search_end_times[-1],
+                search_start_time=search_start_time,
+                search_end_time=search_end_time,
                 user_input=data,
             )
 
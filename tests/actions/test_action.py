@@ -1,16 +1,38 @@
+import asyncio
+import inspect
+import math
+import os
+import pathlib
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import orjson
 import pytest
+from nomad.app.v1.models.models import MetadataPagination, MetadataRequired
+from nomad.config import config as nomad_config
+from pydantic import BaseModel
+from temporalio.exceptions import ApplicationError
 from temporalio.testing import WorkflowEnvironment
 from temporalio.worker import Worker
 
+from nomad_ml_workflows.actions.export_entries import activities, workflows
 from nomad_ml_workflows.actions.export_entries.activities import (
+    SEARCH_CACHE_DIR_NAME,
     cleanup_artifacts,
     create_artifact_subdirectory,
     export_dataset_to_upload,
     merge_output_files,
     search,
+    search_page_after_values,
 )
 from nomad_ml_workflows.actions.export_entries.models import (
+    ExportDatasetInput,
+    ExportDatasetMetadata,
     ExportEntriesUserInput,
+    OutputSettings,
+    SearchInput,
     SearchSettings,
 )
 from nomad_ml_workflows.actions.export_entries.workflows import ExportEntriesWorkflow
@@ -25,9 +47,12 @@ async def test_simple_workflow():
             env.client,
             task_queue=task_queue,
             workflows=[ExportEntriesWorkflow],
+            # the CPU heavy activities are sync and run in the executor threads
+            activity_executor=ThreadPoolExecutor(),
             activities=[
                 create_artifact_subdirectory,
                 search,
+                search_page_after_values,
                 merge_output_files,
                 export_dataset_to_upload,
                 cleanup_artifacts,
@@ -45,3 +70,452 @@ async def test_simple_workflow():
                 task_queue=task_queue,
             )
             assert result is not None
+
+
+def test_export_dataset_to_upload_adds_directory_once(tmp_path):
+    artifact_subdirectory = tmp_path / 'artifacts'
+    raw_dir = tmp_path / 'raw'
+    artifact_subdirectory.mkdir()
+    raw_dir.mkdir()
+    source_paths = []
+    for filename in ['data.parquet', 'data.csv']:
+        source_path = artifact_subdirectory / filename
+        source_path.write_bytes(b'data')
+        source_paths.append(str(source_path))
+
+    upload_files = mock.MagicMock()
+    upload_files.raw_file_object.side_effect = lambda name: mock.Mock(
+        os_path=str(raw_dir / name)
+    )
+    with mock.patch(
+        'nomad_ml_workflows.actions.export_entries.activities.get_upload_files',
+        return_value=upload_files,
+    ):
+        result = export_dataset_to_upload(
+            ExportDatasetInput(
+                user_id='user_id',
+                upload_id='upload_id',
+                artifact_subdirectory=str(artifact_subdirectory),
+                exportable_dir_name='export_entries',
+                zip_output=False,
+                source_paths=source_paths,
+                metadata=ExportDatasetMetadata(),
+            )
+        )
+
+    assert result == 'export_entries'
+    assert sorted(os.listdir(raw_dir / result)) == [
+        'data.csv',
+        'data.parquet',
+        'metadata.json',
+    ]
+    upload_files.add_rawfiles.assert_called_once_with(
+        path=str(raw_dir / result), target_dir=result
+    )
+
+
+def make_search_input(output_file_path: str, **updates) -> SearchInput:
+    fields = dict(
+        user_id='user_id',
+        owner='visible',
+        query={'entry_type': 'ELNSample'},
+        required=MetadataRequired(),
+        pagination=MetadataPagination(page_size=2),
+        batch_file_type='json',
+        output_file_path=output_file_path,
+        max_entries_export_limit=10,
+        cache_max_age=3600,
+        cache_max_size=1024**2,
+    )
+    return SearchInput(**{**fields, **updates})
+
+
+def mock_search_response(entries: list[dict], total: int, next_page_after_value=None):
+    return mock.Mock(
+        data=entries,
+        pagination=mock.Mock(total=total, next_page_after_value=next_page_after_value),
+    )
+
+
+@pytest.fixture
+def artifacts_dir(tmp_path):
+    with mock.patch.object(
+        activities, 'action_artifacts_dir', return_value=str(tmp_path)
+    ):
+        yield tmp_path
+
+
+SEARCH_PAGE = [{'entry_id': 'a'}, {'entry_id': 'b'}]
+
+
+@pytest.fixture
+def nomad_search():
+    with mock.patch.object(
+        activities,
+        'nomad_search',
+        side_effect=lambda **kwargs: mock_search_response(
+            list(SEARCH_PAGE), total=5, next_page_after_value='b'
+        ),
+    ) as nomad_search:
+        yield nomad_search
+
+
+def test_search_cache_key_ignores_output_and_cache_settings(tmp_path):
+    key = activities._search_cache_key(make_search_input(str(tmp_path / '1.json')))
+
+    assert key == activities._search_cache_key(
+        make_search_input(str(tmp_path / '2.json'), cache_max_age=1, cache_max_size=1)
+    )
+    assert key != activities._search_cache_key(
+        make_search_input(str(tmp_path / '1.json'), query={'entry_type': 'Other'})
+    )
+    assert key != activities._search_cache_key(
+        make_search_input(
+            str(tmp_path / '1.json'),
+            pagination=MetadataPagination(page_size=2, page_offset=2),
+        )
+    )
+
+
+def test_search_reuses_cached_page(artifacts_dir, nomad_search):
+    output = search(make_search_input(str(artifacts_dir / '1.json')))
+    cached_output = search(make_search_input(str(artifacts_dir / '2.json')))
+
+    nomad_search.assert_called_once()
+    assert cached_output == output
+    assert (artifacts_dir / '2.json').read_bytes() == (
+        artifacts_dir / '1.json'
+    ).read_bytes()
+    assert orjson.loads((artifacts_dir / '2.json').read_bytes()) == SEARCH_PAGE
+
+
+def test_search_cache_miss_after_max_age(artifacts_dir, nomad_search):
+    search(make_search_input(str(artifacts_dir / '1.json')))
+    nomad_search.reset_mock()
+    expired = time.time() - 7200
+    for entry in os.scandir(artifacts_dir / SEARCH_CACHE_DIR_NAME):
+        os.utime(entry.path, (expired, expired))
+
+    search(make_search_input(str(artifacts_dir / '2.json')))
+
+    nomad_search.assert_called_once()
+
+
+def test_search_cache_miss_for_other_search(artifacts_dir, nomad_search):
+    search(make_search_input(str(artifacts_dir / '1.json')))
+    nomad_search.reset_mock()
+    search(
+        make_search_input(str(artifacts_dir / '2.json'), query={'entry_type': 'Other'})
+    )
+
+    nomad_search.assert_called_once()
+
+
+def test_write_search_cache_evicts_oldest_pages(artifacts_dir):
+    cache_dir = artifacts_dir / SEARCH_CACHE_DIR_NAME
+    cache_dir.mkdir()
+    now = time.time()
+    for name, age in [
+        ('expired.json', 7200),
+        ('old.json', 300),
+        ('recent.json', 200),
+        # written by a concurrent search, and not evicted while in flight
+        ('other.0123.partial', 400),
+    ]:
+        path = cache_dir / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now - age, now - age))
+
+    data = make_search_input(str(artifacts_dir / '1.json'), cache_max_size=250)
+    (artifacts_dir / '1.json').write_bytes(b'[]')
+    activities._write_search_cache(
+        str(cache_dir / 'key'),
+        data,
+        activities.SearchOutput(
+            num_entries_exported=1,
+            num_entries_available=1,
+            search_start_time='start',
+            search_end_time='end',
+        ),
+    )
+
+    assert sorted(os.listdir(cache_dir)) == [
+        'key.json',
+        'key.meta.json',
+        'other.0123.partial',
+        'recent.json',
+    ]
+
+
+def test_search_succeeds_when_caching_fails(artifacts_dir, nomad_search):
+    with mock.patch.object(
+        activities, '_write_search_cache', side_effect=FileNotFoundError
+    ):
+        output = search(make_search_input(str(artifacts_dir / '1.json')))
+
+    assert output.num_entries_exported == len(SEARCH_PAGE)
+    assert (artifacts_dir / '1.json').exists()
+
+
+class FakeSearchIndex:
+    """
+    Answers the searches of the activities from entries ordered by their ID, of which
+    `total` are reported as available. Like Elasticsearch, the next page after value
+    is only returned for full pages, and, like `MetadataPagination`, pages reaching
+    `window` are rejected.
+    """
+
+    def __init__(
+        self,
+        num_entries: int,
+        total: int | None = None,
+        window: int = activities.SEARCH_MAX_RESULT_WINDOW,
+        failing_page_offset: int | None = None,
+    ):
+        self.entry_ids = [f'entry_{index:05d}' for index in range(num_entries)]
+        self.total = num_entries if total is None else total
+        self.window = window
+        self.failing_page_offset = failing_page_offset
+        self.paginations: list[MetadataPagination] = []
+
+    def search(self, *, pagination: MetadataPagination, **kwargs):
+        self.paginations.append(pagination.model_copy())
+        if pagination.page_offset is not None:
+            if pagination.page_offset == self.failing_page_offset:
+                raise RuntimeError('Search failed.')
+            assert pagination.page_offset + pagination.page_size < self.window
+            start = pagination.page_offset
+        elif pagination.page_after_value is not None:
+            start = self.entry_ids.index(pagination.page_after_value) + 1
+        else:
+            start = 0
+        entry_ids = self.entry_ids[start : start + pagination.page_size]
+        return mock_search_response(
+            [{'entry_id': entry_id} for entry_id in entry_ids],
+            total=self.total,
+            next_page_after_value=entry_ids[-1]
+            if len(entry_ids) == pagination.page_size
+            else None,
+        )
+
+
+@pytest.mark.parametrize('response_page_size', [4, 5, 10000])
+@pytest.mark.parametrize(
+    'num_entries_after, max_entries_export_limit',
+    [
+        # exact multiple of the page size
+        (12, 100),
+        (10, 100),
+        (3, 100),
+        (0, 100),
+        # exactly the export limit, and a multiple of the page size
+        (20, 12),
+        (20, 10),
+        (20, 4),
+        (20, 1),
+    ],
+)
+def test_search_page_after_values(
+    tmp_path, num_entries_after, max_entries_export_limit, response_page_size
+):
+    page_size = 4
+    index = FakeSearchIndex(page_size + num_entries_after)
+    # the cursor of the second page points to the last entry of the first page
+    cursor = index.entry_ids[page_size - 1]
+    entry_ids_after = index.entry_ids[page_size:]
+    data = make_search_input(
+        str(tmp_path / '2.json'),
+        pagination=MetadataPagination(page_size=page_size, page_after_value=cursor),
+        max_entries_export_limit=max_entries_export_limit,
+    )
+
+    with (
+        mock.patch.object(activities, 'nomad_search', side_effect=index.search),
+        mock.patch.object(
+            activities, 'PAGE_AFTER_VALUES_PAGE_SIZE', response_page_size
+        ),
+    ):
+        page_after_values = search_page_after_values(data)
+
+    num_entries = min(num_entries_after, max_entries_export_limit)
+    num_pages = max(1, math.ceil(num_entries / page_size))
+    assert page_after_values == [
+        cursor,
+        *(entry_ids_after[page * page_size - 1] for page in range(1, num_pages)),
+    ]
+
+
+@pytest.fixture
+def run_export_workflow(monkeypatch, artifacts_dir):
+    async def run(
+        index: FakeSearchIndex,
+        page_size: int,
+        max_entries_export_limit: int,
+        exported: dict | None = None,
+        activity_delay: Callable[[Callable, BaseModel], float] | None = None,
+    ) -> tuple[ExportDatasetInput, list[dict]]:
+        """
+        Runs the export workflow outside of Temporal, with the activities called
+        directly and the entries searched from `index`. Returns the input of the
+        export activity and the exported entries, which are also stored in
+        `exported`, along with the names of the finished activities in their order.
+        Each activity is started after the delay given by `activity_delay`.
+        """
+        config = nomad_config.get_plugin_entry_point(
+            'nomad_ml_workflows.actions:export_entries'
+        )
+        monkeypatch.setattr(
+            config, 'max_entries_export_limit', max_entries_export_limit
+        )
+        if exported is None:
+            exported = {}
+        finished_activities = exported.setdefault('finished_activities', [])
+
+        async def execute_activity(activity_fn, data, **kwargs):
+            # the activity inputs are serialized by Temporal, and validated again
+            data = type(data).model_validate_json(data.model_dump_json())
+            await asyncio.sleep(
+                activity_delay(activity_fn, data) if activity_delay else 0
+            )
+            try:
+                if activity_fn is export_dataset_to_upload:
+                    exported['input'] = data
+                    exported['entries'] = [
+                        entry
+                        for path in data.source_paths
+                        for entry in orjson.loads(pathlib.Path(path).read_bytes())
+                    ]
+                    return data.exportable_dir_name
+                result = activity_fn(data)
+                return await result if inspect.isawaitable(result) else result
+            finally:
+                finished_activities.append(activity_fn.__name__)
+
+        monkeypatch.setattr(workflows.workflow, 'execute_activity', execute_activity)
+        monkeypatch.setattr(
+            workflows.workflow, 'info', lambda: mock.Mock(workflow_id='workflow_id')
+        )
+        with mock.patch.object(activities, 'nomad_search', side_effect=index.search):
+            await ExportEntriesWorkflow().run(
+                ExportEntriesUserInput(
+                    upload_id='upload_id',
+                    user_id='user_id',
+                    search_settings=SearchSettings(query='{}', page_size=page_size),
+                    output_settings=OutputSettings(output_file_type='json'),
+                )
+            )
+        return exported['input'], exported['entries']
+
+    return run
+
+
+@pytest.mark.parametrize(
+    'num_entries, total, max_entries_export_limit',
+    [
+        # pages addressed by their offset within the result window
+        (6, None, 100),
+        (16, None, 100),
+        (19, None, 100),
+        (30, None, 19),
+        (30, None, 18),
+        (13, 18, 100),
+        # pages addressed by their cursor up to and beyond the result window
+        (20, None, 100),
+        (30, None, 20),
+        (21, None, 100),
+        (24, None, 100),
+        (30, None, 24),
+        (30, None, 22),
+        (25, 30, 100),
+    ],
+)
+@pytest.mark.asyncio
+async def test_workflow_searches_pages_concurrently(
+    monkeypatch, run_export_workflow, num_entries, total, max_entries_export_limit
+):
+    window = 20
+    index = FakeSearchIndex(num_entries, total, window)
+    monkeypatch.setattr(workflows, 'SEARCH_MAX_RESULT_WINDOW', window)
+    page_size = 4
+
+    export_input, entries = await run_export_workflow(
+        index, page_size, max_entries_export_limit
+    )
+
+    num_entries_exported = min(num_entries, max_entries_export_limit)
+    assert [entry['entry_id'] for entry in entries] == (
+        index.entry_ids[:num_entries_exported]
+    )
+    assert export_input.metadata.error_info is None
+    assert export_input.metadata.num_entries_exported == num_entries_exported
+    assert export_input.metadata.num_entries_available == index.total
+    assert export_input.metadata.reached_max_entries_limit == (
+        index.total > max_entries_export_limit
+    )
+    uses_offsets = any(
+        pagination.page_offset is not None for pagination in index.paginations
+    )
+    assert uses_offsets == (min(index.total, max_entries_export_limit) < window)
+    assert uses_offsets != any(
+        pagination.page_size == activities.PAGE_AFTER_VALUES_PAGE_SIZE
+        for pagination in index.paginations
+    )
+    # the page size of the last pages is reduced to the remaining entries
+    assert (
+        sum(
+            pagination.page_size
+            for pagination in index.paginations
+            if pagination.page_size <= page_size
+        )
+        <= max_entries_export_limit
+    )
+
+
+@pytest.mark.asyncio
+async def test_workflow_exports_the_search_result_window(run_export_workflow):
+    # the pages are validated by the pagination, which rejects offset pages reaching
+    # the result window
+    num_entries = activities.SEARCH_MAX_RESULT_WINDOW
+    index = FakeSearchIndex(num_entries)
+
+    export_input, entries = await run_export_workflow(
+        index, page_size=1000, max_entries_export_limit=num_entries
+    )
+
+    assert [entry['entry_id'] for entry in entries] == index.entry_ids
+    assert export_input.metadata.num_entries_exported == num_entries
+
+
+@pytest.mark.asyncio
+async def test_workflow_waits_for_the_searches_of_a_failed_page(
+    monkeypatch, artifacts_dir, run_export_workflow
+):
+    window = 20
+    page_size = 4
+    # the second page fails while the other pages of its batch are still searched
+    index = FakeSearchIndex(16, window=window, failing_page_offset=page_size)
+    monkeypatch.setattr(workflows, 'SEARCH_MAX_RESULT_WINDOW', window)
+    exported = {}
+
+    def activity_delay(activity_fn, data) -> float:
+        if activity_fn is search and data.pagination.page_offset != page_size:
+            return 0.01
+        return 0
+
+    with pytest.raises(ApplicationError):
+        await run_export_workflow(
+            index,
+            page_size,
+            max_entries_export_limit=100,
+            exported=exported,
+            activity_delay=activity_delay,
+        )
+
+    assert 'RuntimeError: Search failed.' in exported['input'].metadata.error_info
+    assert exported['finished_activities'] == [
+        'create_artifact_subdirectory',
+        *(['search'] * 4),
+        'export_dataset_to_upload',
+        'cleanup_artifacts',
+    ]
+    assert not os.path.exists(artifacts_dir / 'workflow_id')
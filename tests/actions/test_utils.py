@@ -0,0 +1,298 @@
+import errno
+import math
+import os
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from nomad.utils import dict_to_dataframe
+
+from nomad_ml_workflows.actions.export_entries import utils
+from nomad_ml_workflows.actions.export_entries.utils import (
+    merge_files,
+    write_json_file,
+    write_parquet_file,
+)
+
+# Whether the dataset writer preserves the order, which needs pyarrow 21 or newer
+PRESERVES_ORDER = [
+    pytest.param(
+        True,
+        marks=pytest.mark.skipif(
+            not utils._WRITE_DATASET_PRESERVES_ORDER,
+            reason='The dataset writer of pyarrow cannot preserve the order.',
+        ),
+    ),
+    False,
+]
+
+
+@pytest.mark.parametrize('preserves_order', PRESERVES_ORDER)
+def test_merge_parquet_files_with_different_schemas(
+    tmp_path, monkeypatch, preserves_order
+):
+    monkeypatch.setattr(utils, '_WRITE_DATASET_PRESERVES_ORDER', preserves_order)
+    batches = [
+        [{'entry_id': f'a{index}', 'x': index} for index in range(3)],
+        [{'entry_id': f'b{index}', 'y': {'z': 0.5}} for index in range(2)],
+        [{'entry_id': f'c{index}', 'x': index + 0.5} for index in range(3)],
+    ]
+    input_file_paths = []
+    for index, batch in enumerate(batches):
+        path = str(tmp_path / f'{index}.parquet')
+        write_parquet_file(path, batch)
+        input_file_paths.append(path)
+
+    output_file_path = str(tmp_path / 'data.parquet')
+    merge_files(input_file_paths, 'parquet', output_file_path)
+
+    table = pq.read_table(output_file_path)
+    assert table.schema == pa.schema(
+        [('entry_id', pa.string()), ('x', pa.float64()), ('y.z', pa.float64())]
+    )
+    assert table.to_pylist() == [
+        *({'entry_id': f'a{index}', 'x': index, 'y.z': None} for index in range(3)),
+        *({'entry_id': f'b{index}', 'x': None, 'y.z': 0.5} for index in range(2)),
+        *(
+            {'entry_id': f'c{index}', 'x': index + 0.5, 'y.z': None}
+            for index in range(3)
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    'column',
+    [
+        pa.array([[1, -2, None], [], None, [2**62]], pa.list_(pa.int64())),
+        pa.array([[0, 255]], pa.list_(pa.uint8())),
+        pa.array([[True, False, None], None], pa.list_(pa.bool_())),
+        pa.array(
+            [
+                [1e10, 2.5e15, 1e16, 1e-6, 1e-5, 0.1, 1.0, 123.456],
+                [math.nan, math.inf, -math.inf, -0.0, None],
+                [],
+                None,
+            ],
+            pa.list_(pa.float64()),
+        ),
+        pa.array([[0.1, 1e10, 3.0]], pa.list_(pa.float32())),
+        pa.array(
+            [['a"b', 'c\\d', 'é€😀', None], [], None, ['x']],
+            pa.list_(pa.string()),
+        ),
+        pa.array([['line\nbreak', 'tab\t', '\x00\x1f']], pa.list_(pa.string())),
+        pa.array([['a', '"'], None, ['b']], pa.large_list(pa.large_string())),
+        pa.array([[1, 2], [3], None, [4, 5, 6], []], pa.list_(pa.int64())).slice(1, 3),
+        pa.array([['a'], ['b\n'], ['"c"'], ['d']], pa.list_(pa.string())).slice(2),
+        pa.array([[[1], [2, 3]], None], pa.list_(pa.list_(pa.int64()))),
+        pa.array([{'k': 1.5}, None], pa.struct([('k', pa.float64())])),
+    ],
+)
+def test_stringify_nested_columns_matches_orjson(column):
+    batch = pa.RecordBatch.from_arrays(
+        [column, pa.array(range(len(column)))], ['a', 'b']
+    )
+
+    stringified = utils._stringify_nested_columns(batch)
+
+    assert stringified.schema == pa.schema([('a', pa.string()), ('b', pa.int64())])
+    assert stringified.column('a').to_pylist() == [
+        orjson.dumps(value).decode() if value is not None else None
+        for value in column.to_pylist()
+    ]
+
+
+def test_primitive_list_to_json_leaves_floats_to_orjson():
+    assert utils._primitive_list_to_json(pa.array([[1, 2]])) is not None
+    assert utils._primitive_list_to_json(pa.array([['a']])) is not None
+    assert utils._primitive_list_to_json(pa.array([[1.5]])) is None
+    assert (
+        utils._primitive_list_to_json(pa.array([[1.5]], pa.list_(pa.float32()))) is None
+    )
+
+
+@pytest.mark.parametrize(
+    'content, elements',
+    [
+        (b'[]', b''),
+        (b' \n[ \n ]\n ', b''),
+        (b'[1]', b'1'),
+        (b'\n [\n  {"a": [1, 2]},\n  "]"\n]\n', b'{"a": [1, 2]},\n  "]"'),
+        (b'', None),
+        (b'{}', None),
+        (b'{"a": []}', None),
+        (b'[1] x', None),
+        (b'[1', None),
+        (b'1]', None),
+    ],
+)
+def test_json_array_elements_span(content, elements):
+    span = utils._json_array_elements_span(content)
+
+    if elements is None:
+        assert span is None
+    else:
+        assert span is not None
+        assert content[span[0] : span[1]] == elements
+
+
+def write_json_batches(tmp_path, batches: list[list[dict]]) -> list[str]:
+    input_file_paths = []
+    for index, batch in enumerate(batches):
+        path = str(tmp_path / f'{index}.json')
+        write_json_file(path, batch)
+        input_file_paths.append(path)
+    return input_file_paths
+
+
+JSON_BATCHES = [
+    [{'entry_id': 'a', 'results': {'x': [1, 2.5], 'y': None}}, {'entry_id': 'b'}],
+    [],
+    [{'entry_id': 'c', 'name': 'é "quoted" ]'}],
+]
+
+
+@pytest.mark.parametrize(
+    'batches',
+    [JSON_BATCHES, [[], []], [[{'entry_id': 'a'}]]],
+    ids=['batches', 'empty', 'single'],
+)
+def test_merge_json_files(tmp_path, batches):
+    output_file_path = tmp_path / 'data.json'
+    merge_files(write_json_batches(tmp_path, batches), 'json', str(output_file_path))
+
+    assert output_file_path.read_bytes() == orjson.dumps(
+        [entry for batch in batches for entry in batch], option=orjson.OPT_INDENT_2
+    )
+
+
+@pytest.mark.parametrize('content', [b'', b'{}', b'[{"entry_id": "a"}] garbage'])
+def test_merge_json_files_rejects_non_array(tmp_path, content):
+    input_file_paths = write_json_batches(tmp_path, JSON_BATCHES)
+    with open(input_file_paths[1], 'wb') as f:
+        f.write(content)
+
+    with pytest.raises(ValueError, match='does not hold a JSON array'):
+        merge_files(input_file_paths, 'json', str(tmp_path / 'data.json'))
+
+
+def test_merge_json_files_without_sendfile(tmp_path, monkeypatch):
+    def sendfile(*args):
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    input_file_paths = write_json_batches(tmp_path, JSON_BATCHES)
+    with open(input_file_paths[0], 'rb') as source, open(os.devnull, 'wb') as output:
+        assert not utils._sendfile(source, output, 0, 1)
+
+    output_file_path = tmp_path / 'data.json'
+    merge_files(input_file_paths, 'json', str(output_file_path))
+
+    assert output_file_path.read_bytes() == orjson.dumps(
+        [entry for batch in JSON_BATCHES for entry in batch],
+        option=orjson.OPT_INDENT_2,
+    )
+
+
+def test_sendfile_raises_after_partial_copy(tmp_path, monkeypatch):
+    calls = []
+
+    def sendfile(out_fd, in_fd, offset, count):
+        calls.append(offset)
+        if len(calls) > 1:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        return 1
+
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    (tmp_path / 'source').write_bytes(b'abc')
+    with (
+        open(tmp_path / 'source', 'rb') as source,
+        open(tmp_path / 'output', 'wb') as output,
+        pytest.raises(OSError),
+    ):
+        # part of the bytes were already copied, so they cannot be written again
+        utils._sendfile(source, output, 0, 3)
+
+
+ENTRIES = [
+    {'entry_id': 'a', 'x': 1, 'l': [None], 'empty': []},
+    {'entry_id': 'b', 'x': 2, 'l': [], 'results': {'n': 1}},
+    {'entry_id': 'c', 'x': 2.5, 'l': [1, 2], 'z': [{'k': 1}, {'k': 2, 'm': []}]},
+    {'entry_id': 'd', 'x': None, 'results': {'n': 2, 's': 'only later'}},
+    {'entry_id': 'e', 'z': [{'k': 3}], 'results': {'n': None}},
+]
+
+
+def test_entries_chunk_to_table_matches_dict_to_dataframe():
+    table = utils._entries_chunk_to_table(ENTRIES)
+    dataframe = dict_to_dataframe(ENTRIES)
+
+    assert table.column_names == sorted(dataframe.columns)
+    for name in table.column_names:
+        assert table.column(name).to_pylist() == [
+            None if isinstance(value, float) and math.isnan(value) else value
+            for value in dataframe[name]
+        ]
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 2, 3, len(ENTRIES)])
+def test_entries_to_table_in_chunks(monkeypatch, chunk_rows):
+    table = utils._entries_chunk_to_table(ENTRIES)
+    monkeypatch.setattr(utils, 'ENTRIES_CHUNK_ROWS', chunk_rows)
+
+    chunked_table = utils._entries_to_table(ENTRIES)
+
+    assert chunked_table.schema == table.schema
+    assert chunked_table.to_pylist() == table.to_pylist()
+    # ints and lists of nulls of the first chunks are promoted by the later ones
+    assert table.schema.field('x').type == pa.float64()
+    assert table.schema.field('l').type == pa.list_(pa.int64())
+    assert table.column('z.1.k').to_pylist() == [None, None, 2, None, None]
+
+
+@pytest.mark.parametrize('preserves_order', PRESERVES_ORDER)
+def test_merged_row_groups_same_on_append_and_dataset_paths(
+    tmp_path, monkeypatch, preserves_order
+):
+    monkeypatch.setattr(utils, 'MERGED_ROW_GROUP_ROWS', 64)
+    monkeypatch.setattr(utils, '_WRITE_DATASET_PRESERVES_ORDER', preserves_order)
+    input_file_paths = []
+    for index in range(10):
+        path = str(tmp_path / f'{index}.parquet')
+        write_parquet_file(
+            path, [{'entry_id': f'{index}-{row}', 'x': row} for row in range(30)]
+        )
+        input_file_paths.append(path)
+    metadatas = [pq.read_metadata(path) for path in input_file_paths]
+    schemas = [metadata.schema.to_arrow_schema() for metadata in metadatas]
+    batch_rows = 16
+
+    utils._append_parquet_row_groups(
+        input_file_paths,
+        metadatas,
+        schemas[0],
+        str(tmp_path / 'appended.parquet'),
+        batch_rows,
+    )
+    utils._write_parquet_dataset(
+        utils._scan_batch_files(input_file_paths, schemas, batch_rows),
+        str(tmp_path / 'dataset.parquet'),
+        utils._merged_row_group_rows(metadatas),
+        batch_rows,
+    )
+
+    row_group_rows = []
+    for name in ['appended.parquet', 'dataset.parquet']:
+        metadata = pq.read_metadata(tmp_path / name)
+        row_group_rows.append(
+            [
+                metadata.row_group(index).num_rows
+                for index in range(metadata.num_row_groups)
+            ]
+        )
+    assert row_group_rows[0] == [64, 64, 64, 64, 44]
+    assert row_group_rows[1] == row_group_rows[0]
+    assert pq.read_table(tmp_path / 'dataset.parquet').equals(
+        pq.read_table(tmp_path / 'appended.parquet')
+    )